@@ -1,8 +1,10 @@
-from collections.abc import Generator
+from collections import OrderedDict
+from collections.abc import Generator, Iterable
+from itertools import accumulate, repeat
 
-from typing import NoReturn, Optional
+from typing import NamedTuple, NoReturn, Optional
 
-from .nbt_encoder import NBTEncoder
+from .nbt_encoder import NBTEncoder, RawNBT
 from .snakey import Snakey
 from .vector import Vector3
 
@@ -39,12 +41,24 @@ class NBTUtils:
     @staticmethod
     def slice_by_length(
             tags: list[dict], encoder: NBTEncoder, init_len: int = 0,
-            post_commands: Optional[list[dict]] = None
+            post_commands: Optional[list[dict]] = None,
+            lengths: Optional[list[int]] = None
     ) -> Generator[int]:
         tags = list(tags)  # make copy
         if post_commands is not None:
             init_len += len(encoder.encode(post_commands))
+        if lengths is None:
+            lengths = [len(encoder.encode(tag)) for tag in tags]
+        elif len(lengths) != len(tags):
+            raise ValueError(
+                f"Got {len(lengths)} lengths for {len(tags)} tags"
+            )
 
+        # Encoded length of tags[:n] is the brackets plus n tags plus the
+        # n - 1 commas between them. tags is consumed from the front, so
+        # offset the sums by the lengths of the tags already sliced off.
+        cumulative_lengths = [0, *accumulate(lengths)]
+        base = 0
         while tags:
             window_addend = len(tags)
             window = window_addend
@@ -54,7 +68,11 @@ class NBTUtils:
                 # It basically finds the largest window over tags which
                 # starts at 0 and contains the longest encoded NBT string
                 # which is less than the command block character limit
-                encoded_len = len(encoder.encode(tags[:window]))
+                encoded_len = (
+                    cumulative_lengths[base + window]
+                    - cumulative_lengths[base]
+                    + max(window, 1) + 1
+                )
 
                 window_addend //= 2
                 if encoded_len + init_len <= COMMAND_BLOCK_TEXT_LIMIT:
@@ -66,6 +84,100 @@ class NBTUtils:
             yield [*tags[:best_window], *post_commands]
             # Remove this slice and continue slicing if anything is left
             del tags[:best_window]
+            base += best_window
+
+
+class EncodedCommand(NamedTuple):
+    """
+    An encoded command block minecart, split where the command's coordinate
+    prefix gets spliced in
+    """
+    head: str
+    tail: str
+    length: int
+
+    def splice(self, prefix: str = '') -> RawNBT:
+        """
+        Get the encoded minecart with `prefix` inserted in front of the
+        command. `prefix` must not contain quotes, backslashes, or
+        non-printable characters, as it is not escaped.
+        """
+        return RawNBT(f"{self.head}{prefix}{self.tail}")
+
+
+class CommandCache:
+
+    def __init__(self, encoder: NBTEncoder, maxsize: int = 1024):
+        """
+        A bounded LRU cache of encoded command block minecarts, keyed by the
+        raw command and whether it is quoted. Repeated commands then only cost
+        a lookup rather than escaping and encoding them again.
+
+        The cache holds no combiner settings of its own; callers pass
+        `quote_commands` to `get` on every call so that changing
+        `CommandCombiner.run_once` after construction is respected.
+
+        :param encoder: the encoder used to encode the minecarts
+        :param maxsize: the maximum number of commands to keep cached
+        """
+        self.encoder = encoder
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple[bool, str], EncodedCommand] = (
+            OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
+
+    def get(self, command: str, quote_commands: bool) -> EncodedCommand:
+        """
+        Get the encoded minecart for `command`.
+
+        :param command: the raw command
+        :param quote_commands: if true, the command is quoted as the value of
+            a `data modify` prefix (see `CommandCombiner.format_commands`)
+        """
+        key = (quote_commands, command)
+        try:
+            encoded = self._cache[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return encoded
+
+        self.misses += 1
+        encoded = self._encode(command, quote_commands)
+        self._cache[key] = encoded
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return encoded
+
+    def clear(self) -> NoReturn:
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _encode(self, command: str, quote_commands: bool) -> EncodedCommand:
+        if quote_commands:
+            command = repr(command)
+        escaped = repr(command)
+        tag = self.encoder.encode(NBTUtils.cmd_minecart(escaped))
+        # The prefix goes right after the opening quote. It contains no
+        # characters that need escaping, so escaping it along with the
+        # command would leave it unchanged.
+        split = tag.index(escaped) + 1
+        return EncodedCommand(tag[:split], tag[split:], len(tag))
 
 
 class CommandCombiner:
@@ -74,7 +186,7 @@ class CommandCombiner:
 
     def __init__(
             self, commands: list[str], dimensions: Optional[Vector3] = None,
-            run_once: bool = False
+            run_once: bool = False, cache_size: int = 1024
     ):
         """
         Combine Minecraft commands into fewer long commands. This uses stacked
@@ -88,6 +200,8 @@ class CommandCombiner:
             commands
         :param run_once: if true, don't create and command blocks and instead
             run the commands straight from the command block minecarts
+        :param cache_size: the maximum number of distinct commands to keep
+            encoded in `command_cache`
         """
         self.commands = commands
         self.nbt_encoder = NBTEncoder(quote_strings=False)
@@ -95,6 +209,7 @@ class CommandCombiner:
             dimensions = Vector3(8, -1, 8)
         self.dimensions = dimensions
         self.run_once = run_once
+        self.command_cache = CommandCache(self.nbt_encoder, maxsize=cache_size)
 
     def combine(self) -> Generator[str]:
         if not self.commands:
@@ -140,23 +255,33 @@ class CommandCombiner:
         )
 
         place_cmd_blocks = self.place_command_blocks()
-        main_commands = self.format_commands()
         cleanup_cmds = [
             'data modify block ~ ~-3 ~ Command set value ""',
             'setblock ~ ~-2 ~ command_block{auto:1b,Command:"fill ~ ~ ~ ~ ~2 ~ air"}',
             'kill @e[type=falling_block,distance=..1]',
             'kill @e[type=command_block_minecart,distance=..1]'
         ]
-        commands = [
-            *place_cmd_blocks, *main_commands
+        commands_minecarts = [
+            NBTUtils.cmd_minecart(repr(cmd)) for cmd in place_cmd_blocks
+        ]
+        minecart_lengths = [
+            len(self.nbt_encoder.encode(minecart))
+            for minecart in commands_minecarts
         ]
-        commands_minecarts = [NBTUtils.cmd_minecart(repr(cmd)) for cmd in commands]
+        # Main commands are mostly repetitive, so they're encoded once each
+        # and their coordinate prefixes are spliced in afterwards
+        for prefix, cmd in zip(self._command_prefixes(), self.commands):
+            encoded = self.command_cache.get(
+                cmd, quote_commands=not self.run_once
+            )
+            commands_minecarts.append(encoded.splice(prefix))
+            minecart_lengths.append(encoded.length + len(prefix))
         cleanup_minecarts = [NBTUtils.cmd_minecart(repr(cmd)) for cmd in cleanup_cmds]
 
         for minecarts_slice in (
                 NBTUtils.slice_by_length(
                     commands_minecarts, self.nbt_encoder, init_len,
-                    post_commands=cleanup_minecarts
+                    post_commands=cleanup_minecarts, lengths=minecart_lengths
                 )
         ):
             falling_blocks[-1]['Passengers'] = minecarts_slice
@@ -225,14 +350,23 @@ class CommandCombiner:
         if self.run_once:
             return self.commands
 
+        return [
+            f"{prefix}{cmd!r}"
+            for prefix, cmd in zip(self._command_prefixes(), self.commands)
+        ]
+
+    def _command_prefixes(self) -> Iterable[str]:
+        if self.run_once:
+            return repeat('')
+        return self._data_modify_prefixes()
+
+    def _data_modify_prefixes(self) -> Generator[str]:
         snakey = Snakey(self.dimensions, len(self.commands))
-        commands = []
-        for pos_and_facing, cmd in zip(snakey, self.commands):
+        for pos_and_facing, _ in zip(snakey, self.commands):
             pos, _ = pos_and_facing
             pos += self.origin
-            commands.append(
+            yield (
                 f"data modify block "
                 f"~{pos.x:.0f} ~{pos.y:.0f} ~{pos.z:.0f} "
-                f"Command set value {cmd!r}"
+                f"Command set value "
             )
-        return commands